@@ -2,11 +2,14 @@
 
 import os
 import re
+import errno
 import logging
+import selectors
 import subprocess
+import textwrap
 import warnings
 from pathlib import Path
-from shutil import copy
+from shutil import copy, copyfile
 from daemonize import Daemonize
 import click
 import platform
@@ -14,15 +17,61 @@ from .picker import pick
 import pyperclip
 from appdirs import user_config_dir
 
-from collections import defaultdict
-from time import time, sleep
-from threading import Timer
+import atexit
+import hashlib
+import heapq
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from time import time, sleep, monotonic
+from threading import Condition, Lock, Thread
 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
 log = logging.getLogger("pdftex-figures")
 
 FILE_EXTENSION = "afdesign"
 
+# Cached parsed version of the installed inkscape, see _get_inkscape_version
+_INKSCAPE_VERSION = None
+_VER_RE = re.compile(r"[0-9.]+")
+
+# Long-lived `inkscape --shell` processes used for exports, see
+# export_in_inkscape_shell. At most _MAX_INKSCAPE_SHELLS are running, and
+# shells that stayed idle for _INKSCAPE_SHELL_IDLE_SECONDS are closed.
+_MAX_INKSCAPE_SHELLS = 2
+_INKSCAPE_SHELL_IDLE_SECONDS = 300
+_INKSCAPE_PROMPT = "> "
+_idle_shells: list[tuple[float, subprocess.Popen]] = []
+_shell_count = 0
+_shell_condition = Condition()
+_shell_reaper: Thread | None = None
+
+# Renders of distinct svgs run in parallel, while renders of the same svg are
+# serialized by a lock per path. Each lock is stored with the number of renders
+# using it, and removed once the last one finishes.
+_render_pool = ThreadPoolExecutor(
+    max_workers=max(2, (os.cpu_count() or 2) // 2)
+)
+_render_locks: dict[str, list] = {}
+_render_locks_lock = Lock()
+_last_render: Future | None = None
+# Running inkscape processes (not shells), keyed by the path of the svg they
+# export
+_exports: dict[str, subprocess.Popen] = {}
+
+# (mtime, size, digest) of each svg when it was last exported successfully,
+# keyed by its path
+_built_figures: dict[str, tuple[int, int, bytes]] = {}
+
+_LATEX_TEMPLATE = (
+    "\\begin{{figure}}[ht]\n"
+    "    \\centering\n"
+    "    \\incfig{{{name}}}\n"
+    "    \\caption{{{title}}}\n"
+    "    \\label{{fig:{name}}}\n"
+    "\\end{{figure}}"
+)
+
 
 def inkscape(path: str | Path) -> None:
     with warnings.catch_warnings():
@@ -33,25 +82,18 @@ def inkscape(path: str | Path) -> None:
 
 
 def indent(text: str, indentation: int = 0) -> str:
-    lines = text.split("\n")
-    return "\n".join(" " * indentation + line for line in lines)
+    # Also pad whitespace-only lines, which textwrap.indent skips by default
+    return textwrap.indent(text, " " * indentation, lambda line: True)
 
 
+@lru_cache(maxsize=1024)
 def beautify(name: str) -> str:
     return name.replace("_", " ").replace("-", " ").title()
 
 
+@lru_cache(maxsize=1024)
 def latex_template(name, title):
-    return "\n".join(
-        (
-            r"\begin{figure}[ht]",
-            r"    \centering",
-            rf"    \incfig{{{name}}}",
-            rf"    \caption{{{title}}}",
-            rf"    \label{{fig:{name}}}",
-            r"\end{figure}",
-        )
-    )
+    return _LATEX_TEMPLATE.format(name=name, title=title)
 
 
 # From https://stackoverflow.com/a/67692
@@ -83,11 +125,40 @@ if not template.is_file():
     destination = str(template)
     _ = copy(source, destination)
 
+# Size of the template, used as a hint when copying it
+template_size = template.stat().st_size
+
 if config.exists():
     config_module = import_file("config", config)
     latex_template = config_module.latex_template
 
 
+def copy_template(destination: str | Path) -> None:
+    """
+    Copy the figure template to the given destination.
+
+    Uses copy_file_range on Linux so that the data never goes through user
+    space, and falls back to a regular copy elsewhere.
+    """
+    if hasattr(os, "copy_file_range"):
+        with open(template, "rb") as src, open(destination, "wb") as dst:
+            try:
+                count = max(template_size, 1)
+                copied = 0
+                while n := os.copy_file_range(
+                    src.fileno(), dst.fileno(), count
+                ):
+                    copied += n
+                # Some filesystems return 0 without copying anything
+                if copied >= template_size:
+                    return
+            except OSError:
+                # e.g. not supported by the filesystem
+                pass
+
+    copyfile(str(template), str(destination))
+
+
 def add_root(path):
     path = str(path)
     roots = get_roots()
@@ -98,10 +169,19 @@ def add_root(path):
     roots_file.write_text("\n".join(roots))
 
 
-def get_roots():
+# Parsed contents of the roots file, keyed by its modification time
+_roots_cache: tuple[int, list[str]] | None = None
+
+
+def get_roots(include_cwd: bool = True):
+    global _roots_cache
     current_dir = os.getcwd()
-    ans = [root for root in roots_file.read_text().split("\n") if root != ""]
-    if current_dir not in ans:
+    mtime = roots_file.stat().st_mtime_ns
+    if _roots_cache is None or _roots_cache[0] != mtime:
+        roots = [r for r in roots_file.read_text().split("\n") if r != ""]
+        _roots_cache = (mtime, roots)
+    ans = list(_roots_cache[1])
+    if include_cwd and current_dir not in ans:
         ans.append(current_dir)
     return ans
 
@@ -117,34 +197,29 @@ def watch(daemon: bool) -> None:
     """
     Watches for figures.
     """
-    if platform.system() == "Linux":
-        watcher_cmd = watch_daemon_inotify
-    else:
-        watcher_cmd = watch_daemon_fswatch
-
     if daemon:
         daemon = Daemonize(
             app="pdftex-figures",
             pid="/tmp/pdftex-figures.pid",
-            action=watcher_cmd,
+            action=run_watcher,
         )
         daemon.start()
         log.info("Watching figures.")
     else:
         log.info("Watching figures.")
-        watcher_cmd()
-
+        run_watcher()
 
-def convert_svg_to_pdf_tex(filepath: Path) -> None:
-    # A file has changed
-    if filepath.suffix != ".svg":
-        log.debug(f"File has changed, but is nog an svg {filepath.suffix}")
-        return
 
-    log.info("Recompiling %s", filepath)
+def _get_inkscape_version() -> list[int]:
+    """
+    Return the installed inkscape version as a list of three integers.
 
-    pdf_path = filepath.parent / (filepath.stem + ".pdf")
-    name = filepath.stem
+    The version is only queried once, as running `inkscape --version` is
+    expensive and the version does not change while watching.
+    """
+    global _INKSCAPE_VERSION
+    if _INKSCAPE_VERSION is not None:
+        return _INKSCAPE_VERSION
 
     inkscape_version = subprocess.check_output(
         ["inkscape", "--version"], universal_newlines=True
@@ -155,13 +230,262 @@ def convert_svg_to_pdf_tex(filepath: Path) -> None:
     # - 'Inkscape 0.92.4 (unknown)' to [0, 92, 4]
     # - 'Inkscape 1.1-dev (3a9df5bcce, 2020-03-18)' to [1, 1]
     # - 'Inkscape 1.0rc1' to [1, 0]
-    v_inkscape: str = re.findall(r"[0-9.]+", inkscape_version)[0]
+    v_inkscape: str = _VER_RE.search(inkscape_version).group(0)
     inkscape_version_number = [int(part) for part in v_inkscape.split(".")]
 
     # Right-pad the array with zeros (so [1, 1] becomes [1, 1, 0])
-    inkscape_version_number = inkscape_version_number + [0] * (
+    _INKSCAPE_VERSION = inkscape_version_number + [0] * (
         3 - len(inkscape_version_number)
     )
+    return _INKSCAPE_VERSION
+
+
+def _read_until_prompt(stdout) -> str | None:
+    """Read the inkscape shell output up to its prompt, None on exit."""
+    output = ""
+    while not output.endswith(_INKSCAPE_PROMPT):
+        char = stdout.read(1)
+        if char == "":
+            return None
+        output += char
+    return output[: -len(_INKSCAPE_PROMPT)]
+
+
+def _start_inkscape_shell() -> subprocess.Popen | None:
+    log.debug("Starting inkscape shell")
+    with warnings.catch_warnings():
+        # leaving a subprocess running after interpreter exit raises a
+        # warning in Python3.7+
+        warnings.simplefilter("ignore", ResourceWarning)
+        try:
+            shell = subprocess.Popen(
+                ["inkscape", "--shell"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+            )
+        except OSError:
+            log.error("Could not start inkscape shell")
+            return None
+
+    # Skip the banner
+    if _read_until_prompt(shell.stdout) is None:
+        log.error("Inkscape shell exited unexpectedly")
+        return None
+    return shell
+
+
+def _close_inkscape_shell(shell: subprocess.Popen) -> None:
+    log.debug("Closing inkscape shell")
+    try:
+        shell.stdin.close()  # type: ignore
+    except OSError:
+        pass
+    shell.terminate()
+    try:
+        shell.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        shell.kill()
+        shell.wait()
+
+
+def _acquire_inkscape_shell() -> subprocess.Popen | None:
+    """
+    Take an idle `inkscape --shell` process, starting one if fewer than
+    _MAX_INKSCAPE_SHELLS are running, or waiting for one otherwise.
+
+    The shell must be handed back with _release_inkscape_shell.
+    """
+    global _shell_count
+    with _shell_condition:
+        while True:
+            while _idle_shells:
+                _, shell = _idle_shells.pop()
+                if shell.poll() is None:
+                    return shell
+                _shell_count -= 1
+            if _shell_count < _MAX_INKSCAPE_SHELLS:
+                _shell_count += 1
+                break
+            _shell_condition.wait()
+
+    shell = _start_inkscape_shell()
+    if shell is None:
+        with _shell_condition:
+            _shell_count -= 1
+            _shell_condition.notify()
+    return shell
+
+
+def _release_inkscape_shell(shell: subprocess.Popen) -> None:
+    global _shell_count, _shell_reaper
+    with _shell_condition:
+        if shell.poll() is None:
+            _idle_shells.append((monotonic(), shell))
+        else:
+            _shell_count -= 1
+        if _shell_reaper is None:
+            _shell_reaper = Thread(target=_reap_idle_shells, daemon=True)
+            _shell_reaper.start()
+        _shell_condition.notify_all()
+
+
+def _reap_idle_shells() -> None:
+    """Close the shells that stayed idle for too long"""
+    global _shell_count
+    with _shell_condition:
+        while True:
+            now = monotonic()
+            keep, expired = [], []
+            for used, shell in _idle_shells:
+                if now - used >= _INKSCAPE_SHELL_IDLE_SECONDS:
+                    expired.append(shell)
+                else:
+                    keep.append((used, shell))
+            _idle_shells[:] = keep
+            for shell in expired:
+                _close_inkscape_shell(shell)
+                _shell_count -= 1
+            if expired:
+                _shell_condition.notify_all()
+
+            if _idle_shells:
+                oldest = min(used for used, _ in _idle_shells)
+                timeout = oldest + _INKSCAPE_SHELL_IDLE_SECONDS - now
+            else:
+                timeout = None
+            _shell_condition.wait(timeout)
+
+
+@atexit.register
+def close_inkscape_shells() -> None:
+    """Close all idle inkscape shells, e.g. when the watcher exits"""
+    global _shell_count
+    with _shell_condition:
+        while _idle_shells:
+            _, shell = _idle_shells.pop()
+            _close_inkscape_shell(shell)
+            _shell_count -= 1
+
+
+def export_in_inkscape_shell(filepath: Path, pdf_path: Path) -> bool:
+    """
+    Export an svg file to pdf + pdf_tex using one of the inkscape shells.
+
+    Returns False if the shell is not available or did not write the pdf and
+    pdf_tex files, in which case the caller should run inkscape directly.
+    """
+    actions = "; ".join(
+        (
+            f"file-open:{filepath}",
+            "export-area-page",
+            "export-dpi:300",
+            "export-type:pdf",
+            "export-latex",
+            f"export-filename:{pdf_path}",
+            "export-do",
+            "file-close",
+        )
+    )
+    shell = _acquire_inkscape_shell()
+    if shell is None:
+        return False
+    try:
+        return _export_in_shell(shell, filepath, pdf_path, actions)
+    finally:
+        _release_inkscape_shell(shell)
+
+
+def _export_in_shell(
+    shell: subprocess.Popen, filepath: Path, pdf_path: Path, actions: str
+) -> bool:
+    # The shell goes back to its prompt even if an action failed, so check
+    # that the exported files were actually rewritten.
+    outputs = (pdf_path, pdf_path.with_suffix(".pdf_tex"))
+    before = [_stat_signature(path) for path in outputs]
+
+    log.debug("Running shell actions:")
+    log.debug(actions)
+    try:
+        shell.stdin.write(actions + "\n")  # type: ignore
+        shell.stdin.flush()  # type: ignore
+    except OSError:
+        output = None
+    else:
+        output = _read_until_prompt(shell.stdout)
+
+    if output is None:
+        log.error("Inkscape shell exited unexpectedly")
+        return False
+    if output.strip():
+        log.debug(output.strip())
+
+    after = [_stat_signature(path) for path in outputs]
+    if any(a is None or a == b for a, b in zip(after, before)):
+        log.error("Inkscape shell did not export %s", filepath)
+        return False
+    return True
+
+
+def _stat_signature(path: Path) -> tuple[int, int, int, int] | None:
+    """Identify a version of a file, None if it does not exist."""
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+def _file_digest(filepath: Path) -> bytes:
+    with open(filepath, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=16).digest()
+
+
+def convert_svg_to_pdf_tex(filepath: Path) -> str | None:
+    """
+    Export an svg file to pdf + pdf_tex.
+
+    Returns the LaTeX code to include the figure, or None if the file is not
+    an svg or no longer exists.
+    """
+    # A file has changed
+    if filepath.suffix != ".svg":
+        log.debug("File has changed, but is nog an svg %s", filepath.suffix)
+        return None
+
+    snippet = latex_template(filepath.stem, beautify(filepath.stem))
+    pdf_path = filepath.parent / (filepath.stem + ".pdf")
+
+    # Many editors write files even when their content did not change, skip
+    # the export if the svg is identical to the one that was last exported
+    # and both exported files are still there.
+    try:
+        stat = filepath.stat()
+    except FileNotFoundError:
+        log.debug("File has changed, but no longer exists %s", filepath)
+        return None
+    key = str(filepath)
+    digest = None
+    built = _built_figures.get(key)
+    if (
+        built is not None
+        and pdf_path.exists()
+        and pdf_path.with_suffix(".pdf_tex").exists()
+    ):
+        if built[:2] == (stat.st_mtime_ns, stat.st_size):
+            log.debug("File is unchanged, skipping %s", filepath)
+            return snippet
+        digest = _file_digest(filepath)
+        if built[2] == digest:
+            log.debug("File content is unchanged, skipping %s", filepath)
+            _built_figures[key] = (stat.st_mtime_ns, stat.st_size, digest)
+            return snippet
+    if digest is None:
+        digest = _file_digest(filepath)
+
+    log.info("Recompiling %s", filepath)
+
+    inkscape_version_number = _get_inkscape_version()
 
     # Tuple comparison is like version comparison
     if inkscape_version_number < [1, 0, 0]:
@@ -188,19 +512,44 @@ def convert_svg_to_pdf_tex(filepath: Path) -> None:
             pdf_path,
         ]
 
-    log.debug("Running command:")
-    log.debug(" ".join(str(e) for e in command))
-
-    # Recompile the svg file
-    completed_process = subprocess.run(command)
-
-    if completed_process.returncode != 0:
-        log.error("Return code %s", completed_process.returncode)
+    # Inkscape 1.0+ can export through a long-lived shell, which avoids
+    # paying for the startup of inkscape on every save. Actions are separated
+    # by ';', so paths containing one go through a separate process.
+    if (
+        inkscape_version_number >= [1, 0, 0]
+        and ";" not in str(filepath)
+        and export_in_inkscape_shell(filepath, pdf_path)
+    ):
+        log.debug("Export succeeded")
+        succeeded = True
     else:
-        log.debug("Command succeeded")
-
-    # Copy the LaTeX code to include the file to the clipboard
-    pyperclip.copy(latex_template(name, beautify(name)))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Running command:")
+            log.debug("%s", " ".join(map(str, command)))
+
+        # Recompile the svg file. The process is registered so that a newer
+        # change to the same file can terminate it, see render_figure.
+        process = subprocess.Popen(command)
+        _exports[key] = process
+        try:
+            returncode = process.wait()
+        finally:
+            superseded = _exports.get(key) is not process
+            if not superseded:
+                del _exports[key]
+
+        succeeded = returncode == 0
+        if not succeeded and superseded:
+            log.info("Export of %s was interrupted", filepath)
+        elif not succeeded:
+            log.error("Return code %s", returncode)
+        else:
+            log.debug("Command succeeded")
+
+    if succeeded:
+        _built_figures[key] = (stat.st_mtime_ns, stat.st_size, digest)
+
+    return snippet
 
 
 def maybe_recompile_figure(filepath: str | Path) -> None:
@@ -213,64 +562,269 @@ def maybe_recompile_figure(filepath: str | Path) -> None:
         Path to the file that has changed.
 
     """
-    filepath = Path(filepath)
-
-    # A file has changed
-    if filepath.suffix not in (".svg", ".afdesign"):
-        log.debug(f"File has changed, but is supported {filepath.suffix}")
+    # A file has changed. Reject unsupported files (swap files, .git, ...)
+    # before building a Path for them.
+    if not str(filepath).endswith((".svg", ".afdesign")):
+        log.debug("File has changed, but is not supported %s", filepath)
         return
 
+    filepath = Path(filepath)
+
     if filepath.suffix == ".afdesign":
         log.info("Converting to SVG %s", filepath)
         afdesign_to_svg(filepath)
-
-    if filepath.suffix == ".svg":
-        log.info(f"Recompiling {filepath}")
-        convert_svg_to_pdf_tex(filepath)
+        # Copy the LaTeX code to include the file to the clipboard
+        pyperclip.copy(latex_template(filepath.stem, beautify(filepath.stem)))
+    else:
+        render_figure(filepath)
+
+
+def _render_serialized(filepath: Path) -> str | None:
+    key = str(filepath)
+    with _render_locks_lock:
+        entry = _render_locks.setdefault(key, [Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            return convert_svg_to_pdf_tex(filepath)
+    finally:
+        with _render_locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _render_locks[key]
+
+
+def _render_done(future: Future) -> None:
+    """Copy the LaTeX code of the most recently submitted render"""
+    try:
+        snippet = future.result()
+    except Exception:
+        log.exception("Could not recompile figure")
+        return
 
     # Copy the LaTeX code to include the file to the clipboard
-    pyperclip.copy(latex_template(filepath.stem, beautify(filepath.stem)))
-
+    if future is _last_render and snippet is not None:
+        pyperclip.copy(snippet)
 
-def watch_daemon_inotify():
-    import inotify.adapters
-    from inotify.constants import IN_CLOSE_WRITE
 
-    while True:
-        roots = get_roots()
+def render_figure(filepath: Path) -> Future:
+    """
+    Recompile an svg file in the render pool.
+
+    Distinct files are exported concurrently. A running inkscape process
+    exporting the same file is terminated, as its output is stale, and
+    unregistered so the export knows it was superseded. Exports in the
+    inkscape shell are left to finish, restarting the shell would cost more
+    than the stale export. The LaTeX code is
+    copied to the clipboard once the render finishes, unless another file was
+    submitted in the meantime.
+    """
+    global _last_render
+    process = _exports.pop(str(filepath), None)
+    if process is not None and process.poll() is None:
+        log.debug("Terminating stale export of %s", filepath)
+        process.terminate()
 
-        # Watch the file with contains the paths to watch
-        # When this file changes, we update the watches.
-        i = inotify.adapters.Inotify()
-        i.add_watch(str(roots_file), mask=IN_CLOSE_WRITE)
+    future = _render_pool.submit(_render_serialized, filepath)
+    _last_render = future
+    future.add_done_callback(_render_done)
+    return future
 
-        # Watch the actual figure directories
-        log.info("Watching directories: " + ", ".join(get_roots()))
-        for root in roots:
-            try:
-                i.add_watch(root, mask=IN_CLOSE_WRITE)
-            except Exception:
-                log.debug("Could not add root %s", root)
 
-        for event in i.event_gen(yield_nones=False):
-            (_, type_names, path, filename) = event
+def _watch_inotify(roots: list[str], recursive_roots: list[str]):
+    """
+    Create an inotify instance watching the roots file and the figure
+    directories. Nested folders are only watched for the roots in
+    `recursive_roots`, i.e. the ones listed in the roots file, since the
+    implicit working directory may well be / or $HOME.
 
-            # If the file containing figure roots has changes, update the
-            # watches
-            if path == str(roots_file):
-                log.info("The roots file has been updated. Updating watches.")
-                for root in roots:
-                    try:
-                        i.remove_watch(root)
-                        log.debug("Removed root %s", root)
-                    except Exception:
-                        log.debug("Could not remove root %s", root)
-                # Break out of the loop, setting up new watches.
+    Returns the instance and a mapping from watch descriptors to paths.
+    """
+    from inotify_simple import INotify, flags
+
+    # Watch the file with contains the paths to watch
+    # When this file changes, we update the watches.
+    inotify = INotify()
+    watches = {
+        inotify.add_watch(str(roots_file), flags.CLOSE_WRITE): str(roots_file)
+    }
+
+    # Watch the actual figure directories. Only report writes, and skip
+    # events for files that were unlinked
+    mask = flags.CLOSE_WRITE | flags.ONLYDIR | flags.EXCL_UNLINK
+    failed = []
+    stack = [(root, root in recursive_roots) for root in reversed(roots)]
+    while stack:
+        directory, recursive = stack.pop()
+        try:
+            wd = inotify.add_watch(directory, mask)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                log.warning(
+                    "Reached the inotify watch limit "
+                    "(fs.inotify.max_user_watches), not watching %s and "
+                    "%d more directories",
+                    directory,
+                    len(stack),
+                )
                 break
+            failed.append(directory)
+            continue
+        watches[wd] = directory
+
+        if not recursive:
+            continue
+        # Skip hidden folders such as .git
+        try:
+            with os.scandir(directory) as it:
+                stack.extend(
+                    (e.path, True)
+                    for e in it
+                    if not e.name.startswith(".")
+                    and e.is_dir(follow_symlinks=False)
+                )
+        except OSError:
+            failed.append(directory)
+    if failed:
+        log.debug("Could not add roots %s", ", ".join(failed))
+
+    return inotify, watches
+
+
+def _read_inotify(inotify, watches: dict[int, str]) -> list[str]:
+    """Return the files written since the last read, without blocking."""
+    from inotify_simple import flags
+
+    paths = []
+    for event in inotify.read(timeout=0):
+        path = watches.get(event.wd)
+        if path is None or not event.mask & flags.CLOSE_WRITE:
+            continue
+        # The roots file is watched directly and has no event name
+        paths.append(os.path.join(path, event.name) if event.name else path)
+    return paths
+
+
+def _read_fswatch(stdout, partial: bytearray) -> list[str] | None:
+    """
+    Return the complete lines fswatch has written since the last read, or
+    None if fswatch exited.
+    """
+    data = os.read(stdout.fileno(), 65536)
+    if not data:
+        return None
+    partial += data
+    *lines, rest = bytes(partial).split(b"\n")
+    partial[:] = rest
+    return [os.fsdecode(line) for line in lines if line]
 
-            # A file has changed
-            path = Path(path) / filename
-            maybe_recompile_figure(path)
+
+def run_watcher() -> None:
+    """
+    Watch the figure directories and recompile figures as they change.
+
+    Changes are read from inotify on Linux and from fswatch elsewhere. A
+    single selector waits for either new changes or the next debounce
+    deadline, so one thread handles both.
+    """
+    use_inotify = platform.system() == "Linux"
+    # Wait time after last change. inotify only reports completed writes,
+    # while fswatch reports every modification.
+    debounce_seconds = 0.2 if use_inotify else 1.0
+
+    # Pending compilations, mapping each file to the deadline (monotonic) of
+    # its debounce period. The heap orders the same deadlines so only the
+    # earliest one needs to be looked at; heap entries whose deadline no
+    # longer matches the dictionary were superseded by a later change.
+    # The dictionary is bounded, dropping the least recently changed file.
+    pending: OrderedDict[str, float] = OrderedDict()
+    deadlines: list[tuple[float, str]] = []
+    max_pending = 4096
+
+    def schedule(filepath: str) -> None:
+        """(Re)schedule compilation after debounce period"""
+        deadline = monotonic() + debounce_seconds
+        if filepath in pending:
+            log.debug("Resetting debounce timer for %s", filepath)
+            pending.move_to_end(filepath)
+        pending[filepath] = deadline
+        heapq.heappush(deadlines, (deadline, filepath))
+        if len(pending) > max_pending:
+            dropped, _ = pending.popitem(last=False)
+            log.debug("Too many pending files, dropping %s", dropped)
+
+    def flush(now: float) -> None:
+        """Compile every file whose deadline has passed"""
+        while deadlines and deadlines[0][0] <= now:
+            deadline, filepath = heapq.heappop(deadlines)
+            if pending.get(filepath) == deadline:
+                del pending[filepath]
+                maybe_recompile_figure(filepath)
+
+    while True:
+        roots = get_roots()
+        log.info("Watching directories: " + ", ".join(roots))
+
+        selector = selectors.DefaultSelector()
+        if use_inotify:
+            inotify, watches = _watch_inotify(
+                roots, get_roots(include_cwd=False)
+            )
+            selector.register(inotify, selectors.EVENT_READ)
+        else:
+            # Watch the figures directories, as well as the config directory
+            # containing the roots file. If the latter changes, restart the
+            # watches.
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", ResourceWarning)
+                p = subprocess.Popen(
+                    ["fswatch", *roots, str(user_dir)],
+                    stdout=subprocess.PIPE,
+                )
+            partial = bytearray()
+            selector.register(p.stdout, selectors.EVENT_READ)
+
+        update_watches = False
+        while not update_watches:
+            if deadlines:
+                timeout = max(0.0, deadlines[0][0] - monotonic())
+            else:
+                timeout = None
+
+            if selector.select(timeout):
+                if use_inotify:
+                    paths = _read_inotify(inotify, watches)
+                else:
+                    paths = _read_fswatch(p.stdout, partial)
+                    if paths is None:
+                        log.error("fswatch exited. Restarting watches.")
+                        break
+
+                for filepath in paths:
+                    # If the file containing figure roots has changes,
+                    # update the watches once this batch is scheduled
+                    if filepath == str(roots_file):
+                        log.info(
+                            "The roots file has been updated. "
+                            "Updating watches."
+                        )
+                        update_watches = True
+                        continue
+                    schedule(filepath)
+
+            flush(monotonic())
+
+        selector.close()
+        if use_inotify:
+            # Closing the inotify instance removes all of its watches
+            inotify.close()
+        else:
+            p.terminate()
+            p.wait()
+            log.debug("Removed main watch")
+
+        # Do not lose changes that were still waiting to be recompiled
+        flush(float("inf"))
 
 
 def watch_daemon_fswatch_old():
@@ -304,50 +858,6 @@ def watch_daemon_fswatch_old():
             maybe_recompile_figure(filepath)
 
 
-def watch_daemon_fswatch():
-    # Dictionary to track pending compilations
-    pending_timers = {}
-    debounce_seconds = 1.0  # Wait time after last change
-
-    def debounced_compile(filepath: str | Path):
-        """Compile after debounce period with no new changes"""
-        if filepath in pending_timers:
-            del pending_timers[filepath]
-        maybe_recompile_figure(filepath)
-
-    while True:
-        roots = get_roots()
-        log.info("Watching directories: " + ", ".join(roots))
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", ResourceWarning)
-            p = subprocess.Popen(
-                ["fswatch", *roots, str(user_dir)],
-                stdout=subprocess.PIPE,
-                universal_newlines=True,
-            )
-        while True:
-            filepath = p.stdout.readline().strip()  # type: ignore  # noqa
-            if filepath == str(roots_file):
-                log.info("The roots file has been updated. Updating watches.")
-                p.terminate()
-                log.debug("Removed main watch %s")
-                # Cancel all pending timers
-                for timer in pending_timers.values():
-                    timer.cancel()
-                pending_timers.clear()
-                break
-
-            # Cancel existing timer for this file if any
-            if filepath in pending_timers:
-                pending_timers[filepath].cancel()
-                log.debug(f"Resetting debounce timer for {filepath}")
-
-            # Schedule new compilation after debounce period
-            timer = Timer(debounce_seconds, debounced_compile, args=[filepath])
-            pending_timers[filepath] = timer
-            timer.start()
-
-
 @cli.command()
 @click.argument("title")
 @click.argument(
@@ -377,7 +887,7 @@ def create(title: str, root: str) -> None:
         print(title + " 2")
         return
 
-    _ = copy(str(template), str(figure_path))
+    copy_template(figure_path)
 
     # copy FILE_EXTENSION file
     title = title.strip()
@@ -393,7 +903,7 @@ def create(title: str, root: str) -> None:
         print(title + " 2")
         return
 
-    _ = copy(str(template), str(figure_path))
+    copy_template(figure_path)
 
     add_root(figures)
     open_svg_file(figure_path)
@@ -455,21 +965,41 @@ def afdesign_to_svg(filepath: str | Path) -> None:
     export_path = export_folder / f"{filepath.stem}.svg"
     # delete export_path if it exists
     if export_path.exists():
-        log.info(f"Deleting existing SVG {export_path}")
+        log.info("Deleting existing SVG %s", export_path)
         os.remove(export_path)
 
+    # Instead of fixed delays, the script polls the UI state every 50ms until
+    # the next dialog is ready, giving up after 2 seconds.
     applescript = f"""
-    -- Focus Affinity Designer
-    tell application "Affinity Designer 2"
-        activate
+    -- Focus Affinity Designer, unless it is already frontmost. Activating
+    -- launches it if it is not running.
+    tell application "System Events"
+        set isFrontmost to false
+        if exists process "Affinity Designer 2" then
+            set isFrontmost to frontmost of process "Affinity Designer 2"
+        end if
     end tell
+    if not isFrontmost then
+        tell application "Affinity Designer 2"
+            activate
+        end tell
+        tell application "System Events"
+            repeat 40 times
+                if exists process "Affinity Designer 2" then
+                    if frontmost of process "Affinity Designer 2" then
+                        exit repeat
+                    end if
+                end if
+                delay 0.05
+            end repeat
+        end tell
+    end if
 
     -- Save current alert volume
     set originalVolume to alert volume of (get volume settings)
     -- Mute alert volume
     set volume alert volume 0
     -- display dialog "No document window is open in Affinity Designer 2"
-    delay 0.1
 
     -- Open the .afdesign file and save as SVG
     tell application "System Events"
@@ -477,41 +1007,58 @@ def afdesign_to_svg(filepath: str | Path) -> None:
             key code 53
             -- Export to SVG
             keystroke "s" using {{command down, shift down, option down}}
-            delay 0.2
-            -- Choose SVG tab
+            -- The export dialog is either a sheet or a window of its own
+            repeat 40 times
+                if exists sheet 1 of window 1 then exit repeat
+                if exists button "Export" of window 1 then exit repeat
+                delay 0.05
+            end repeat
+            -- Choose SVG tab. The tab switch has no state to poll for.
             keystroke "2" using {{command down}}
             delay 0.2
             -- Press Export button (Enter key)
             try
                 click button "Export" of window 1
             end try
+            -- Wait for the save panel, which unlike the export sheet has a
+            -- splitter group
+            repeat 40 times
+                if exists splitter group 1 of sheet 1 of window 1 then
+                    exit repeat
+                end if
+                delay 0.05
+            end repeat
             -- Navigate to the same directory using Cmd+Shift+G (Go to folder)
             keystroke "g" using {{command down, shift down}}
-            delay 1
-            -- Type the directory path
+            repeat 40 times
+                if exists sheet 1 of sheet 1 of window 1 then exit repeat
+                delay 0.05
+            end repeat
+            -- Type the directory path. Give the autocomplete popup time to
+            -- appear, otherwise escape cancels the whole Go to folder sheet.
             keystroke "{export_folder}"
             delay 1
             -- escape key to stop editing the path
             key code 53
             delay 0.2
             keystroke return
-            delay 0.2
-
-
-
-            delay 0.2
+            repeat 40 times
+                if not (exists sheet 1 of sheet 1 of window 1) then exit repeat
+                delay 0.05
+            end repeat
             -- Handle the macOS Save dialog
             -- click button "Save" of splitter group 1 of sheet 1 of window 1
             keystroke return
-            -- delay 0.2
             -- try
             --     click button "Replace" of sheet 1 of sheet 1 of window 1
             -- end try
+            repeat 40 times
+                if not (exists sheet 1 of window 1) then exit repeat
+                delay 0.05
+            end repeat
         end tell
     end tell
 
-    delay 0.2
-
     -- Restore original alert volume
     set volume alert volume originalVolume
     """
@@ -551,13 +1098,19 @@ def edit(root: str) -> None:
     else:
         figures = Path(root).absolute()
 
-        # Find svg files and sort them
-        files = figures.glob(f"*.{FILE_EXTENSION}")
-
-        files = sorted(files, key=lambda f: f.stat().st_mtime, reverse=True)
+        # Find svg files and sort them, most recently modified first
+        suffix = f".{FILE_EXTENSION}"
+        with os.scandir(figures) as it:
+            entries = [
+                (e.name, e.stat().st_mtime, e.path)
+                for e in it
+                if e.name.endswith(suffix) and e.is_file()
+            ]
+        entries.sort(key=lambda t: t[1], reverse=True)
+        files = [Path(p) for _, _, p in entries]
 
         # Open a selection dialog using a gui picker like rofi
-        names = [beautify(f.stem) for f in files]
+        names = [beautify(n[: -len(suffix)]) for n, _, _ in entries]
         _, index, selected = pick(names)
         path = files[index]
     if selected:
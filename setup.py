@@ -11,7 +11,7 @@ def readme():
 dependencies = ["pyperclip", "click", "appdirs", "daemonize"]
 if find_executable("fswatch") is None:
     if platform.system() == "Linux":
-        dependencies.append("inotify")
+        dependencies.append("inotify_simple")
     else:
         raise ValueError(
             "inkscape-figures needs fswatch to run on MacOS. You "